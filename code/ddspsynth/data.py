@@ -1,4 +1,6 @@
 import os, json, glob, copy, csv, pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
@@ -8,10 +10,24 @@ import librosa
 from scipy.io.wavfile import read as readwav
 import torch.nn.functional as F
 
-# import torchcrepe
 import tqdm
 from ddspsynth.spectral import compute_f0
 from ddspsynth.util import pad_or_trim_to_expected_length
+
+def prefetch(fn, items, prefetch_factor=4):
+    """map fn over items in a background thread
+    keeps up to prefetch_factor results ready so that loading overlaps with whatever the caller does (ex. f0 estimation)
+    yields results in order
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) > prefetch_factor:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
 class FeatureData(Dataset):
     """Single feature data"""
     def __init__(self, feature, feature_files, normalize=True, transforms=None, set_type=None, train_noise=False, stats=None):
@@ -332,13 +348,16 @@ class FilteredNsynthDataset(Dataset):
 
     def generate_f0s(self):
         print('generating f0')
-        with tqdm.tqdm(self.filtered_dict.values()) as pbar:
-            for entry in pbar:
-                if not entry['note_str'] in self.f0s:
-                    audio_path = os.path.join(self.raw_dir, entry['note_str']+'.wav')
-                    audio, _sr = librosa.load(audio_path, sr=self.sample_rate, duration=self.length)
-                    f0 = compute_f0(audio, sample_rate=self.sample_rate, frame_rate=75, viterbi=True)
-                    self.f0s[entry['note_str']] = f0
+        entries = [entry for entry in self.filtered_dict.values() if not entry['note_str'] in self.f0s]
+        def load(entry):
+            audio_path = os.path.join(self.raw_dir, entry['note_str']+'.wav')
+            audio, _sr = librosa.load(audio_path, sr=self.sample_rate, duration=self.length)
+            return entry, audio
+        # load next audio files in the background while crepe runs
+        with tqdm.tqdm(prefetch(load, entries), total=len(entries)) as pbar:
+            for entry, audio in pbar:
+                f0 = compute_f0(audio, sample_rate=self.sample_rate, frame_rate=75, viterbi=True)
+                self.f0s[entry['note_str']] = f0
         with open(self.f0_file_path, 'wb') as f:
             pickle.dump(self.f0s, f)
     
@@ -432,23 +451,26 @@ class TinySOLDataset(Dataset):
         return audio
 
     def generate_f0s(self):
-        audio_paths = []
-        f0_paths = []
         print('generating f0')
-        with tqdm.tqdm(self.csv_data) as pbar:
-            for entry in pbar:
-                audio_path = os.path.join(self.audio_dir, entry['Path'])
-                f0_path = os.path.splitext(entry['Path'])[0]+'_f0.npy'
-                f0_path = os.path.join(self.audio_dir, f0_path)
-                # save audio that has been cropped and resampled 
-                resample_path = os.path.splitext(entry['Path'])[0] + '_{0}.npy'.format(self.sample_rate)
-                resample_path = os.path.join(self.audio_dir, resample_path)
-                if not os.path.exists(resample_path):
-                    audio = self.load_audio(audio_path)
-                    np.save(resample_path, audio)
-                    if not os.path.exists(f0_path):
-                        f0 = compute_f0(audio, sample_rate=self.sample_rate, frame_rate=50, viterbi=True)
-                        np.save(f0_path, f0)
+        file_paths = [] # (audio_path, resample_path, f0_path) of files not resampled yet
+        for entry in self.csv_data:
+            audio_path = os.path.join(self.audio_dir, entry['Path'])
+            f0_path = os.path.splitext(entry['Path'])[0]+'_f0.npy'
+            f0_path = os.path.join(self.audio_dir, f0_path)
+            # save audio that has been cropped and resampled 
+            resample_path = os.path.splitext(entry['Path'])[0] + '_{0}.npy'.format(self.sample_rate)
+            resample_path = os.path.join(self.audio_dir, resample_path)
+            if not os.path.exists(resample_path):
+                file_paths.append((audio_path, resample_path, f0_path))
+        def load(paths):
+            return paths, self.load_audio(paths[0])
+        # load next audio files in the background while crepe runs
+        with tqdm.tqdm(prefetch(load, file_paths), total=len(file_paths)) as pbar:
+            for (audio_path, resample_path, f0_path), audio in pbar:
+                np.save(resample_path, audio)
+                if not os.path.exists(f0_path):
+                    f0 = compute_f0(audio, sample_rate=self.sample_rate, frame_rate=50, viterbi=True)
+                    np.save(f0_path, f0)
 
     # def create_splits(self, splits, shuffle_files):
     #     nb_files = len(self.csv_data)
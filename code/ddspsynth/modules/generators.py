@@ -7,13 +7,17 @@ class Additive(Gen):
     """Synthesize audio with a bank of harmonic sinusoidal oscillators.
     code mostly borrowed from DDSP"""
 
-    def __init__(self, n_samples=64000, sample_rate=16000, scale_fn=util.exp_sigmoid, normalize_below_nyquist=True, name='harmonic', n_harmonics=64):
+    def __init__(self, n_samples=64000, sample_rate=16000, scale_fn=util.exp_sigmoid, normalize_below_nyquist=True, name='harmonic', n_harmonics=64, softmax_harmonics=False):
+        """
+        softmax_harmonics: normalize harmonic_distribution with a (bandlimited) softmax instead of scale_fn and dividing by the sum
+        """
         super().__init__(name=name)
         self.n_samples = n_samples
         self.sample_rate = sample_rate
         self.scale_fn = scale_fn
         self.normalize_below_nyquist = normalize_below_nyquist
         self.n_harmonics = n_harmonics
+        self.softmax_harmonics = softmax_harmonics
 
     def forward(self, amplitudes, harmonic_distribution, f0_hz, n_samples=None):
         """Synthesize audio with additive synthesizer from controls.
@@ -32,17 +36,30 @@ class Additive(Gen):
         # Scale the amplitudes.
         if self.scale_fn is not None:
             amplitudes = self.scale_fn(amplitudes)
-            harmonic_distribution = self.scale_fn(harmonic_distribution)
+            if not self.softmax_harmonics:
+                harmonic_distribution = self.scale_fn(harmonic_distribution)
         if len(f0_hz.shape) < 3: # when given as a condition
             f0_hz = f0_hz[:, :, None]
-        # Bandlimit the harmonic distribution.
-        if self.normalize_below_nyquist:
-            n_harmonics = int(harmonic_distribution.shape[-1])
-            harmonic_frequencies = util.get_harmonic_frequencies(f0_hz, n_harmonics)
-            harmonic_distribution = util.remove_above_nyquist(harmonic_frequencies, harmonic_distribution, self.sample_rate)
-
-        # Normalize
-        harmonic_distribution /= torch.sum(harmonic_distribution, axis=-1, keepdim=True)
+        if self.softmax_harmonics:
+            # Bandlimit by masking with -inf before softmax (same as removing then renormalizing)
+            if self.normalize_below_nyquist:
+                n_harmonics = int(harmonic_distribution.shape[-1])
+                harmonic_frequencies = util.get_harmonic_frequencies(f0_hz, n_harmonics)
+                # f0 can have a different number of frames from the decoder output (same as remove_above_nyquist)
+                if harmonic_frequencies.shape[1] != harmonic_distribution.shape[1]:
+                    harmonic_frequencies = util.resample_frames(harmonic_frequencies, harmonic_distribution.shape[1])
+                harmonic_distribution = harmonic_distribution.masked_fill(harmonic_frequencies >= self.sample_rate / 2.0, float('-inf'))
+            # Normalize
+            harmonic_distribution = torch.softmax(harmonic_distribution, dim=-1)
+        else:
+            # Bandlimit the harmonic distribution.
+            if self.normalize_below_nyquist:
+                n_harmonics = int(harmonic_distribution.shape[-1])
+                harmonic_frequencies = util.get_harmonic_frequencies(f0_hz, n_harmonics)
+                harmonic_distribution = util.remove_above_nyquist(harmonic_frequencies, harmonic_distribution, self.sample_rate)
+
+            # Normalize
+            harmonic_distribution /= torch.sum(harmonic_distribution, axis=-1, keepdim=True)
 
         signal = util.harmonic_synthesis(frequencies=f0_hz, amplitudes=amplitudes, harmonic_distribution=harmonic_distribution, n_samples=n_samples, sample_rate=self.sample_rate)
         return signal
@@ -116,7 +133,8 @@ class FilteredNoise(Gen):
         if self.scale_fn:
             freq_response = self.scale_fn(freq_response + self.initial_bias)
 
-        audio = (torch.rand(batch_size, n_samples)*2.0-1.0).to(freq_response.device) * self.amplitude
+        # uniform noise in [-amplitude, amplitude] generated directly on device
+        audio = torch.empty(batch_size, n_samples, device=freq_response.device, dtype=freq_response.dtype).uniform_(-self.amplitude, self.amplitude)
         filtered = util.fir_filter(audio, freq_response, self.filter_size)
         return filtered
     
@@ -167,7 +185,9 @@ class SawOscillator(Gen):
         self.n_samples = n_samples
         self.sample_rate = sample_rate
         self.scale_fn = scale_fn
-        self.waveform = torch.linspace(1.0, -1.0, 2048) # saw waveform, will interpolate later anyways
+        # saw waveform, will interpolate later anyways
+        # registered as buffer so that it moves with the module (not saved in state_dict)
+        self.register_buffer('waveform', torch.linspace(1.0, -1.0, 2048), persistent=False)
     
     def forward(self, amplitudes, f0_hz, n_samples=None):
         """forward pass of saw oscillator
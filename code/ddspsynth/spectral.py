@@ -1,19 +1,94 @@
+import functools
+import math
 import torch
+import torch.fft
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
-import librosa
 from torchaudio.transforms import MelScale
 from torchaudio.functional import create_dct
 from ddspsynth.util import log_eps, pad_or_trim_to_expected_length
-import crepe
+import torchcrepe
 
-amp = lambda x: x[...,0]**2 + x[...,1]**2
+def fast_stft(audio, n_fft, hop_length, window=None, center=False):
+    """stft as unfold + rfft
+    same as torch.stft(audio, n_fft, hop_length, window=window, center=center, return_complex=True) (reflect padding when center)
+    but skips the torch.stft overhead
+
+    Args:
+        audio: Shape [(batch), n_samples]
+        window: window of size n_fft. Rectangular if None.
+    Returns:
+        complex stft: Shape [(batch), n_fft // 2 + 1, n_frames]
+    """
+    if center:
+        audio = F.pad(audio.reshape(-1, 1, audio.shape[-1]), (n_fft // 2, n_fft // 2), mode='reflect').reshape(audio.shape[:-1] + (-1,))
+    frames = audio.unfold(-1, n_fft, hop_length) # [(batch), n_frames, n_fft]
+    if window is not None:
+        frames = frames * window
+    # keep the torch.stft layout of frequency before time
+    return torch.fft.rfft(frames, n=n_fft, dim=-1).transpose(-1, -2)
+
+def amp(z):
+    """power of complex stft output"""
+    return z.real.square() + z.imag.square()
+
+@functools.lru_cache(maxsize=32)
+def hann_window(size, device=None, dtype=None):
+    """hann window cached by (size, device, dtype) so that it isn't rebuilt/copied every step
+    treat the returned tensor as read-only
+    """
+    return torch.hann_window(size, device=device, dtype=dtype)
+
+@functools.lru_cache(maxsize=16)
+def hann_dft_basis(size, device=None, dtype=None):
+    """hann windowed real dft basis [size, 2 * (size // 2 + 1)]
+    first half of the columns is the real part (cos), second half the imaginary part (-sin)
+    treat the returned tensor as read-only
+    """
+    n = torch.arange(size, dtype=torch.float64)
+    k = torch.arange(size // 2 + 1, dtype=torch.float64)
+    angle = 2 * math.pi * n[:, None] * k[None, :] / size
+    window = torch.hann_window(size, dtype=torch.float64)[:, None]
+    basis = torch.cat([torch.cos(angle), -torch.sin(angle)], dim=1) * window
+    return basis.to(device=device, dtype=dtype).contiguous()
+
+def dft_power_spectrogram(audio, size, hop_length):
+    """hann windowed power spectrogram (center=False) computed as frames @ dft basis
+    same as amp(fast_stft(audio, size, hop_length, window=hann_window(size))) up to float rounding
+    fp32 as long as it isn't run under autocast (cuda matmuls don't use TF32 by default)
+
+    Args:
+        audio: Shape [(batch), n_samples]
+    Returns:
+        power spectrogram: Shape [(batch), size // 2 + 1, n_frames]
+    """
+    n_bins = size // 2 + 1
+    frames = audio.unfold(-1, size, hop_length) # [(batch), n_frames, size]
+    spec = torch.matmul(frames, hann_dft_basis(size, audio.device, audio.dtype)) # [(batch), n_frames, 2 * n_bins]
+    power = spec[..., :n_bins].square() + spec[..., n_bins:].square()
+    return power.transpose(-1, -2)
+
+@functools.lru_cache(maxsize=8)
+def a_weighting(sample_rate, n_fft, device=None, dtype=torch.float32, min_db=-80.0):
+    """A-weighting of each fft bin [1, n_fft // 2 + 1, 1] cached by (sample_rate, n_fft, device, dtype)
+    same as librosa.A_weighting(librosa.fft_frequencies(sr=sample_rate, n_fft=n_fft))
+    treat the returned tensor as read-only
+    """
+    # computed in double then cast
+    f_sq = torch.linspace(0, sample_rate / 2, n_fft // 2 + 1, device=device, dtype=torch.float64) ** 2
+    c = [12194.217**2, 20.598997**2, 107.65265**2, 737.86223**2]
+    weighting = 2.0 + 20.0 * (math.log10(c[0]) + 2 * torch.log10(f_sq)
+                              - torch.log10(f_sq + c[0]) - torch.log10(f_sq + c[1])
+                              - 0.5 * torch.log10(f_sq + c[2]) - 0.5 * torch.log10(f_sq + c[3]))
+    weighting = torch.clamp(weighting, min=min_db) # log10(0) at DC is -inf
+    return weighting.to(dtype)[None, :, None]
 
 class MelSpec(nn.Module):
-    def __init__(self, n_fft=2048, hop_length=1024, n_mels=128, sample_rate=16000, power=1, f_min=40, f_max=7600, pad_end=True, center=False):
+    def __init__(self, n_fft=2048, hop_length=1024, n_mels=128, sample_rate=16000, power=1, f_min=40, f_max=7600, pad_end=True, center=False, use_compile=False, bf16=False):
         """
-        
+        use_compile: fuse the ops in forward with torch.compile (requires pytorch 2.x)
+        bf16: run the mel projection in bfloat16 on cuda (output is cast back to the input dtype)
         """
         super().__init__()
         self.n_fft = n_fft
@@ -25,69 +100,96 @@ class MelSpec(nn.Module):
         self.n_mels = n_mels
         self.pad_end = pad_end
         self.center = center
+        self.bf16 = bf16
         self.mel_scale = MelScale(self.n_mels, self.sample_rate, self.f_min, self.f_max, self.n_fft // 2 + 1)
-    
+        self.use_compile = use_compile
+        self._forward = torch.compile(self._forward_impl, mode='reduce-overhead') if use_compile else self._forward_impl
+
     def forward(self, audio):
+        return self._forward(audio)
+
+    def _forward_impl(self, audio):
         if self.pad_end:
             _batch_dim, l_x = audio.shape
             remainder = (l_x - self.n_fft) % self.hop_length
             pad = 0 if (remainder == 0) else self.hop_length - remainder
             audio = F.pad(audio, (0, pad), 'constant')
         spec = spectrogram(audio, self.n_fft, self.hop_length, self.power, self.center)
-        mel_spec = self.mel_scale(spec)
-        return mel_spec
+        # stft stays in full precision, only the matmul is autocast
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.bf16 and spec.is_cuda):
+            # use the filterbank directly instead of MelScale.forward (transposes)
+            # (batch, n_freqs, time) dot (n_freqs, n_mels) -> (batch, n_mels, time)
+            mel_spec = torch.einsum('bft,fm->bmt', spec, self.mel_scale.fb)
+        return mel_spec.to(spec.dtype)
 
 class Mfcc(nn.Module):
-    def __init__(self, n_fft=2048, hop_length=1024, n_mels=128, n_mfcc=40, norm='ortho', sample_rate=16000, f_min=40, f_max=7600, pad_end=True, center=False):
+    def __init__(self, n_fft=2048, hop_length=1024, n_mels=128, n_mfcc=40, norm='ortho', sample_rate=16000, f_min=40, f_max=7600, pad_end=True, center=False, bf16=False):
         """
         uses log mels
+        bf16: run the mel projection and dct in bfloat16 on cuda (log is taken in full precision)
         """
         super().__init__()
         self.norm = norm
         self.n_mfcc = n_mfcc
-        self.melspec = MelSpec(n_fft, hop_length, n_mels, sample_rate, power=2, f_min=f_min, f_max=f_max, pad_end=pad_end, center=center)
+        self.bf16 = bf16
+        self.melspec = MelSpec(n_fft, hop_length, n_mels, sample_rate, power=2, f_min=f_min, f_max=f_max, pad_end=pad_end, center=center, bf16=bf16)
         dct_mat = create_dct(self.n_mfcc, self.melspec.n_mels, self.norm)
         self.register_buffer('dct_mat', dct_mat)
 
     def forward(self, audio):
         mel_spec = self.melspec(audio)
-        mel_spec = torch.log(mel_spec+1e-6)
-        # (batch, n_mels, time).tranpose(...) dot (n_mels, n_mfcc)
-        # -> (batch, time, n_mfcc).tranpose(...)
-        mfcc = torch.matmul(mel_spec.transpose(1, 2), self.dct_mat).transpose(1, 2)
-        return mfcc
+        mel_spec = log_eps(mel_spec, 1e-6)
+        # (batch, n_mels, time) dot (n_mels, n_mfcc) -> (batch, n_mfcc, time)
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.bf16 and mel_spec.is_cuda):
+            mfcc = torch.einsum('bmt,mn->bnt', mel_spec, self.dct_mat)
+        return mfcc.to(mel_spec.dtype)
 
 def spectrogram(audio, size=2048, hop_length=1024, power=2, center=False, window=None):
-    power_spec = amp(torch.stft(audio, size, window=window, hop_length=hop_length, center=center))
+    power_spec = amp(fast_stft(audio, size, hop_length, window=window, center=center))
     if power == 2:
         spec = power_spec
     elif power == 1:
         spec = power_spec.sqrt()
     return spec
 
-def MultiscaleFFT(audio, sizes=[64, 128, 256, 512, 1024, 2048], overlap=0.75) -> torch.Tensor:
+def MultiscaleFFT(audio, sizes=[64, 128, 256, 512, 1024, 2048], overlap=0.75, hop_lengths=None, dft_max_size=0) -> torch.Tensor:
     """multiscale fft power spectrogram
-    uses torch.stft so it should be differentiable
+    uses rfft (or a dft matmul for small sizes) so it should be differentiable
 
     Args:
         audio : (batch) input audio tensor Shape: [(batch), n_samples]
         sizes : fft sizes. Defaults to [64, 128, 256, 512, 1024, 2048].
         overlap : overlap between windows. Defaults to 0.75.
+        hop_lengths : precomputed hop length for each size. Computed from overlap if None.
+        dft_max_size : sizes up to this use a matmul with a dft basis instead of rfft. Defaults to 0 (always rfft).
     """
     specs = []
     if isinstance(audio, np.ndarray):
         audio = torch.from_numpy(audio)
-    for size in sizes:
-        window = torch.hann_window(size).to(audio.device)
-        stft = torch.stft(audio, size, window=window, hop_length=int((1-overlap)*size), center=False)
+    if hop_lengths is None:
+        hop_lengths = [int((1-overlap)*size) for size in sizes]
+    for size, hop_length in zip(sizes, hop_lengths):
+        if size <= dft_max_size:
+            specs.append(dft_power_spectrogram(audio, size, hop_length))
+            continue
+        window = hann_window(size, audio.device, audio.dtype)
+        stft = fast_stft(audio, size, hop_length, window=window, center=False)
         specs.append(amp(stft))
     return specs
 
+@torch.jit.script
+def weighted_db(power: torch.Tensor, weighting: torch.Tensor, ref_db: float, range_db: float) -> torch.Tensor:
+    """power spectrogram -> weighted dB clamped to [-range_db, ...]
+    scripted so that the pointwise ops are fused
+    """
+    loudness = 10.0 * torch.log10(power + 1e-5) + weighting - ref_db
+    return torch.clamp(loudness, min=-range_db)
+
 def compute_loudness(audio, sample_rate=16000, frame_rate=50, n_fft=2048, range_db=120.0, ref_db=20.7):
     """Perceptual loudness in dB, relative to white noise, amplitude=1.
 
     Args:
-        audio: tensor. Shape [batch_size, audio_length] or [audio_length].
+        audio: tensor. Shape [batch_size, audio_length]. Use compute_loudness_1d for [audio_length].
         sample_rate: Audio sample rate in Hz.
         frame_rate: Rate of loudness frames in Hz.
         n_fft: Fft window size.
@@ -95,71 +197,79 @@ def compute_loudness(audio, sample_rate=16000, frame_rate=50, n_fft=2048, range_
         ref_db: Sets the reference maximum perceptual loudness as given by (A_weighting + 10 * log10(abs(stft(audio))**2.0). The default value corresponds to white noise with amplitude=1.0 and n_fft=2048. There is a slight dependence on fft_size due to different granularity of perceptual weighting.
 
     Returns:
-        Loudness in decibels. Shape [batch_size, n_frames] or [n_frames,].
+        Loudness in decibels. Shape [batch_size, n_frames].
     """
-    # Temporarily a batch dimension for single examples.
-    is_1d = (len(audio.shape) == 1)
-    if is_1d:
-        audio = audio[None, :]
+    assert audio.ndim == 2, 'audio should be [batch_size, audio_length]'
 
     # Take STFT.
     hop_length = sample_rate // frame_rate
-    s = torch.stft(audio, n_fft=n_fft, hop_length=hop_length)
+    s = fast_stft(audio, n_fft, hop_length, center=True)
     # batch, frequency_bins, n_frames
 
-    # Compute power of each bin
-    amplitude = torch.sqrt(amp(s) + 1e-5) #sqrt(0) gives nan gradient
-    power_db = torch.log10(amplitude + 1e-5)
-    power_db *= 20.0
-
-    # Perceptual weighting.
-    frequencies = librosa.fft_frequencies(sr=sample_rate, n_fft=n_fft)
-    a_weighting = librosa.A_weighting(frequencies)[None, :, None]
-    loudness = power_db + torch.from_numpy(a_weighting.astype(np.float32)).to(audio.device)
-
-    # Set dynamic range.
-    loudness -= ref_db
-    loudness = torch.clamp(loudness, min=-range_db)
+    # Compute power of each bin, perceptual weighting and dynamic range.
+    power = amp(s)
+    loudness = weighted_db(power, a_weighting(sample_rate, n_fft, power.device, power.dtype), ref_db, range_db)
 
     # Average over frequency bins.
     loudness = torch.mean(loudness, dim=1)
 
-    # Remove temporary batch dimension.
-    loudness = loudness[0] if is_1d else loudness
-
     # Compute expected length of loudness vector
     n_secs = audio.shape[-1] / float(sample_rate)  # `n_secs` can have milliseconds
     expected_len = int(n_secs * frame_rate)
 
     # Pad with `-range_db` noise floor or trim vector
-    loudness = pad_or_trim_to_expected_length(loudness, expected_len, -range_db)
+    if loudness.shape[-1] != expected_len:
+        loudness = pad_or_trim_to_expected_length(loudness, expected_len, -range_db)
     return loudness
 
-def compute_f0(audio, sample_rate, frame_rate, viterbi=True):
-    """Fundamental frequency (f0) estimate using CREPE.
+def compute_loudness_1d(audio, *args, **kwargs):
+    """compute_loudness for a single example
 
-    This function is non-differentiable and takes input as a numpy array.
     Args:
-        audio: Numpy ndarray of single audio example. Shape [audio_length,].
+        audio: tensor. Shape [audio_length].
+        other arguments are passed to compute_loudness
+
+    Returns:
+        Loudness in decibels. Shape [n_frames,].
+    """
+    return compute_loudness(audio[None, :], *args, **kwargs)[0]
+
+# lowest pitch bin of CREPE (~31.7Hz), bins are 20 cents apart from 1997.38 cents
+# nudged up 0.2 cents so that torchcrepe's floor quantization of fmin still lands on bin 0
+CREPE_FMIN = 10 * 2 ** ((1997.3794084376191 + 0.2) / 1200)
+
+def compute_f0(audio, sample_rate, frame_rate, viterbi=True, device=None, batch_size=512, fmin=CREPE_FMIN, fmax=torchcrepe.MAX_FMAX):
+    """Fundamental frequency (f0) estimate using CREPE (torchcrepe).
+
+    This function is non-differentiable and returns a numpy array.
+    Args:
+        audio: Numpy ndarray or tensor of single audio example. Shape [audio_length,].
         sample_rate: Sample rate in Hz.
         frame_rate: Rate of f0 frames in Hz.
         viterbi: Use Viterbi decoding to estimate f0.
+        device: Device to run CREPE on. Uses cuda if available when None.
+        batch_size: Number of frames CREPE processes at once.
+        fmin, fmax: Range of f0 to decode in Hz. Defaults to all of CREPE's pitch bins (~31.7Hz to ~2006Hz).
 
     Returns:
         f0_hz: Fundamental frequency in Hz. Shape [n_frames,].
     """
 
     n_secs = len(audio) / float(sample_rate)  # `n_secs` can have milliseconds
-    crepe_step_size = 1000 / frame_rate  # milliseconds
+    hop_length = int(sample_rate / frame_rate)  # samples
     expected_len = int(n_secs * frame_rate)
-    audio = np.asarray(audio)
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    audio = torch.as_tensor(audio, dtype=torch.float32, device=device)
 
     # Compute f0 with crepe.
-    _, f0_hz, f0_confidence, _ = crepe.predict(audio, sr=sample_rate, viterbi=viterbi, step_size=crepe_step_size, center=False, verbose=0)
+    decoder = torchcrepe.decode.viterbi if viterbi else torchcrepe.decode.weighted_argmax
+    with torch.no_grad():
+        f0_hz = torchcrepe.predict(audio[None, :], sample_rate, hop_length=hop_length, fmin=fmin, fmax=fmax, model='full', decoder=decoder, batch_size=batch_size, device=device, pad=False)
 
     # Postprocessing on f0_hz
-    f0_hz = pad_or_trim_to_expected_length(torch.from_numpy(f0_hz), expected_len, 0)  # pad with 0
-    f0_hz = f0_hz.numpy().astype(np.float32)
+    f0_hz = pad_or_trim_to_expected_length(f0_hz[0], expected_len, 0)  # pad with 0
+    f0_hz = f0_hz.cpu().numpy()
 
     # # Postprocessing on f0_confidence
     # f0_confidence = pad_or_trim_to_expected_length(f0_confidence, expected_len, 1)
@@ -168,14 +278,20 @@ def compute_f0(audio, sample_rate, frame_rate, viterbi=True):
     return f0_hz
 
 class SpectralLoss(nn.Module):
-    def __init__(self, fft_sizes=[64, 128, 256, 512, 1024, 2048], overlap=0.75, sample_rate=16000, mag_w=1.0, log_mag_w=1.0, loud_w=0.0):
+    def __init__(self, fft_sizes=[64, 128, 256, 512, 1024, 2048], overlap=0.75, sample_rate=16000, mag_w=1.0, log_mag_w=1.0, loud_w=0.0, use_compile=False):
+        """
+        use_compile: torch.compile forward (same as MelSpec)
+        """
         super().__init__()
         self.fft_sizes = fft_sizes
         self.overlap = overlap
+        self.hop_lengths = [int((1-overlap)*size) for size in fft_sizes]
         self.mag_w = mag_w
         self.log_mag_w = log_mag_w
         self.loud_w = loud_w
         self.sample_rate = sample_rate# only needed for loudness
+        self.use_compile = use_compile
+        self._forward = torch.compile(self._forward_impl, mode='reduce-overhead') if use_compile else self._forward_impl
 
     def loss_func(self, input, target, loss_type, reduction='mean'):
         if loss_type == 'L1':
@@ -184,6 +300,18 @@ class SpectralLoss(nn.Module):
             return F.mse_loss(input, target, reduction='mean')
         if loss_type == 'smooth_L1':
             return F.smooth_l1_loss(input, target, reduction='mean')
+
+    def multiscale_loss_func(self, inputs, targets, loss_type):
+        """sum of losses over lists of spectrograms with different shapes
+        L1/MSE use _foreach ops so that each stage is one launch for all scales instead of one per scale
+        """
+        if loss_type == 'L1':
+            norms = torch._foreach_norm(torch._foreach_sub(inputs, targets), 1)
+            return sum(n / x.numel() for n, x in zip(norms, inputs))
+        if loss_type == 'MSE':
+            norms = torch._foreach_norm(torch._foreach_sub(inputs, targets), 2)
+            return sum(n.square() / x.numel() for n, x in zip(norms, inputs))
+        return sum(self.loss_func(x, y, loss_type) for x, y in zip(inputs, targets))
     
     def forward(self, input_audio, target_audio, loss_type='L1', reduction='mean'):
         """get loss of input audio
@@ -194,17 +322,22 @@ class SpectralLoss(nn.Module):
             loss_type (str, optional): Loss function for comparing spectral feature. Defaults to 'L1'.
             reduction (str, optional): Reduce by mean/sum or None. Defaults to 'mean'.
         """
-        specs = MultiscaleFFT(input_audio, self.fft_sizes, self.overlap)
-        target_specs = MultiscaleFFT(target_audio, self.fft_sizes, self.overlap)
+        return self._forward(input_audio, target_audio, loss_type, reduction)
+
+    def _forward_impl(self, input_audio, target_audio, loss_type, reduction):
+        # run stft on input and target together [2*batch, n_samples]
+        both_audio = torch.cat([input_audio, target_audio], dim=0)
+        both_specs = MultiscaleFFT(both_audio, self.fft_sizes, self.overlap, self.hop_lengths)
         
-        batch_size = input_audio.shape[0]
         loss = 0.0
-        for i, spec in enumerate(specs):
-            target_spec = target_specs[i]
-            if self.mag_w > 0:
-                loss += self.mag_w * self.loss_func(spec, target_spec, loss_type, reduction)
-            if self.log_mag_w > 0:
-                loss += self.log_mag_w * self.loss_func(log_eps(spec), log_eps(target_spec), loss_type, reduction)
+        if self.mag_w > 0:
+            specs, target_specs = zip(*[both_spec.chunk(2, dim=0) for both_spec in both_specs])
+            loss += self.mag_w * self.multiscale_loss_func(list(specs), list(target_specs), loss_type)
+        if self.log_mag_w > 0:
+            # same as log_eps over all scales
+            log_specs = torch._foreach_log(torch._foreach_add(both_specs, 1e-4))
+            log_specs, log_target_specs = zip(*[log_spec.chunk(2, dim=0) for log_spec in log_specs])
+            loss += self.log_mag_w * self.multiscale_loss_func(list(log_specs), list(log_target_specs), loss_type)
         
         if self.loud_w > 0: # don't use this
             input_l = compute_loudness(input_audio, self.sample_rate)
@@ -58,14 +58,14 @@ class Synthesizer(nn.Module):
         Returns:
             dag_input: {'amp': torch.Tensor [batch, n_frames, 1], }
         """
-        curr_idx = 0
         dag_input = {}
         batch_size = input_tensor.shape[0]
         n_frames = input_tensor.shape[1]
         # parameters fed from input_tensor
-        for ext_param, param_size in self.ext_param_sizes.items():
-            dag_input[ext_param] = input_tensor[:,:, curr_idx:curr_idx+param_size]
-            curr_idx += param_size
+        # split once and make each parameter contiguous instead of passing strided slices to the processors
+        ext_params = input_tensor.split(list(self.ext_param_sizes.values()), dim=-1)
+        for ext_param, value in zip(self.ext_param_sizes.keys(), ext_params):
+            dag_input[ext_param] = value.contiguous()
         for param_name, param_value in self.fixed_params.items():
             if param_value is None:
                 value = conditioning[param_name] 
@@ -1,10 +1,13 @@
 import torch
+import torch.fft
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 import math
 
-def log_eps(x, eps=1e-4):
+@torch.jit.script
+def log_eps(x: torch.Tensor, eps: float = 1e-4) -> torch.Tensor:
+    # scripted so that add+log can be fused
     return torch.log(x+eps)
 
 def exp_sigmoid(x, exponent=10.0, max_value=2.0, threshold=1e-7):
@@ -53,7 +56,7 @@ def wavetable_synthesis(frequencies, amplitudes, wavetable, n_samples = 64000, s
     
     phase_velocity = frq_env / float(sample_rate)
     phase = torch.cumsum(phase_velocity, 1)[:, :-1] % 1.0
-    phase = torch.cat([torch.zeros(batch_size, 1), phase], dim=1) # exclusive cumsum starting at 0
+    phase = torch.cat([torch.zeros(batch_size, 1, device=phase.device, dtype=phase.dtype), phase], dim=1) # exclusive cumsum starting at 0
     audio = linear_lookup(phase, wavetable)
     audio *= amp_env
     return audio
@@ -68,7 +71,7 @@ def linear_lookup(phase, wavetable):
     """
     phase = phase[:, :, None]
     len_waveform = wavetable.shape[-1]
-    phase_wavetable = torch.linspace(0.0, 1.0, len_waveform)
+    phase_wavetable = torch.linspace(0.0, 1.0, len_waveform, device=phase.device, dtype=phase.dtype)
 
     # Get pair-wise distances from the oscillator phase to each wavetable point.
     # Axes are [batch, time, len_waveform].
@@ -390,18 +393,12 @@ def crop_and_compensate_delay(audio, audio_size, ir_size, padding, delay_compens
     return audio[:, start:-end]
 
 def fir_filter(audio, freq_response, filter_size):
-    batch_size = audio.shape[0]
-    n_ir_frames = freq_response.shape[1]
-
-    # Reshape filter coefficients to complex form
-    freq_response = freq_response.unsqueeze(-1).expand([batch_size, n_ir_frames, filter_size // 2 + 1, 2]).contiguous()
-    freq_response[:, :, :, 1] = 0 # phase = 0
-    # get IR
-    h = torch.irfft(freq_response, 1, signal_sizes=(filter_size,))
+    # get IR (freq_response is real so phase = 0)
+    h = torch.fft.irfft(freq_response, n=filter_size)
 
     # Compute filter windowed impulse response
     # window_size == filter_size
-    filter_window = torch.hann_window(filter_size).roll(filter_size//2,-1).to(audio.device)
+    filter_window = torch.hann_window(filter_size, device=h.device, dtype=h.dtype).roll(filter_size//2,-1)
     h = filter_window[None, None, :] * h
     filtered = fft_convolve(audio, h, padding='same')
     return filtered
@@ -473,23 +470,18 @@ def fft_convolve(audio, impulse_response, padding = 'same', delay_compensation =
             'number of impulse response frames must be a multiple of the audio '
             'size.'.format(n_audio_frames, n_ir_frames))
 
-    # Pad and FFT the audio and impulse responses.
+    # Pad (to a power of 2) and FFT the audio and impulse responses.
     fft_size = get_fft_size(frame_size, ir_size)
-    audio_frames = nn.functional.pad(audio_frames, (0,fft_size-frame_size), 'constant', 0)
-    impulse_response = nn.functional.pad(impulse_response, (0,fft_size-ir_size), 'constant', 0)
-
-    S = torch.rfft(audio_frames, 1)
-    H = torch.rfft(impulse_response, 1)
+    S = torch.fft.rfft(audio_frames, n=fft_size)
+    H = torch.fft.rfft(impulse_response, n=fft_size)
 
     # Multiply the FFTs (same as convolution in time).
     # Filter the original audio
-    audio_ir_fft          = torch.zeros_like(H)
-    audio_ir_fft[:,:,:,0] = H[:,:,:,0] * S[:,:,:,0] - H[:,:,:,1] * S[:,:,:,1]
-    audio_ir_fft[:,:,:,1] = H[:,:,:,0] * S[:,:,:,1] + H[:,:,:,1] * S[:,:,:,0]
+    audio_ir_fft = H * S
 
     # Take the IFFT to resynthesize audio.
     # batch_size, n_frames, fft_size
-    audio_frames_out = torch.irfft(audio_ir_fft, 1, signal_sizes=(fft_size,))
+    audio_frames_out = torch.fft.irfft(audio_ir_fft, n=fft_size)
     audio_out = overlap_and_add(audio_frames_out, frame_size)
 
     # Crop and shift the output audio.
@@ -58,6 +58,7 @@ if __name__ == "__main__":
     # performance related arguments
     parser.add_argument('--device',         type=str,   default='cuda',         help='Device for CUDA')
     parser.add_argument('--nbworkers',      type=int,   default=4,              help='')
+    parser.add_argument('--compile',        action='store_true',                help='torch.compile the spectral loss (pytorch 2.x)')
 
     args = parser.parse_args()
     torchaudio.set_audio_backend("sox_io")
@@ -75,6 +76,8 @@ if __name__ == "__main__":
     # set device
     device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     print('Optimization will be on ' + str(device) + '.')
+    # input shapes are fixed so let cudnn pick the fastest algorithms
+    torch.backends.cudnn.benchmark = True
 
     # load dataset
     # precomputed features
@@ -120,7 +123,7 @@ if __name__ == "__main__":
     model = DDSPSynth(ae_model, synth).to(device)
     total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('total parameters of the model: {0}'.format(total_params))
-    recon_loss = SpectralLoss(args.fft_sizes, log_mag_w=1.0, mag_w=1.0)
+    recon_loss = SpectralLoss(args.fft_sizes, log_mag_w=1.0, mag_w=1.0, use_compile=args.compile)
 
     with open(os.path.join(args.output, 'args.txt'), 'w') as f:
         json.dump(args.__dict__, f, indent=4)